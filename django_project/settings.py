@@ -129,8 +129,34 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 AUTH_USER_MODEL = 'person.Person'
 
+# Loads the session user from a short-lived per worker cache
+AUTHENTICATION_BACKENDS = ['person.backends.CachedModelBackend']
+
 REST_FRAMEWORK = {
     'PAGE_SIZE': 2,
     'DEFAULT_PAGINATION_CLASS':
     'rest_framework.pagination.PageNumberPagination',
 }
+
+# Cache used for /person/stats/ results. It must be shared by web and job
+# worker processes so invalidation reaches all of them, the database cache
+# needs no extra service (create its table with `manage.py createcachetable`)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'person_cache',
+    },
+    # Authenticated users, keep this one local to each worker process
+    'person-users': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'person-users',
+    },
+}
+
+PERSON_STATS_CACHE_TIMEOUT = 3600
+PERSON_USER_CACHE_TTL = 30
+
+# Background person jobs, see `manage.py run_person_jobs`
+PERSON_JOB_DIR = BASE_DIR / 'jobs'
+PERSON_JOB_CHUNK_SIZE = 500
+PERSON_JOB_STALE_TIMEOUT = 300
@@ -1,5 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import Person
+from .models import Person, ArchivedPerson
 
-admin.site.register(Person, UserAdmin)
\ No newline at end of file
+admin.site.register(Person, UserAdmin)
+admin.site.register(ArchivedPerson)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class PersonConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'person'
+
+    def ready(self):
+        from person import signals  # noqa: F401
@@ -0,0 +1,33 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.functions import Coalesce
+from person.models import ArchivedPerson
+
+
+ARCHIVED_FIELDS = ['username', 'password', 'first_name', 'last_name', 'email', 'phone',
+                   'date_of_birth', 'is_staff', 'date_joined', 'last_login', 'deleted_at']
+
+
+def archivable_persons(cutoff):
+    # Inactive persons whose last sign of life is older than cutoff
+    return (
+        get_user_model().objects.filter(is_active=False)
+        .annotate(inactive_since=Coalesce('deleted_at', 'last_login', 'date_joined'))
+        .filter(inactive_since__lt=cutoff)
+    )
+
+
+def archive_persons(cutoff, chunk_size=500):
+    # Copies persons into the archive table and deletes them, one chunk per transaction
+    archived = 0
+    while True:
+        with transaction.atomic():
+            persons = list(archivable_persons(cutoff).order_by('id')[:chunk_size])
+            if not persons:
+                return archived
+            ArchivedPerson.objects.bulk_create([
+                ArchivedPerson(original_id=person.pk, **{name: getattr(person, name) for name in ARCHIVED_FIELDS})
+                for person in persons
+            ])
+            get_user_model().objects.filter(id__in=[person.pk for person in persons]).delete()
+        archived += len(persons)
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+
+
+# Per worker process cache, invalidation only reaches the worker it runs in
+# and the short TTL bounds how stale other workers can be
+USER_CACHE_ALIAS = getattr(settings, 'PERSON_USER_CACHE_ALIAS', 'person-users')
+USER_CACHE_TTL = getattr(settings, 'PERSON_USER_CACHE_TTL', 30)
+
+
+def user_cache_key(user_id):
+    return f'person:user:{user_id}'
+
+
+def forget_users(user_ids):
+    caches[USER_CACHE_ALIAS].delete_many([user_cache_key(user_id) for user_id in user_ids])
+
+
+class CachedModelBackend(ModelBackend):
+    # Session auth calls get_user() on every request, serve it from cache
+    def get_user(self, user_id):
+        cache = caches[USER_CACHE_ALIAS]
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(key, user, timeout=USER_CACHE_TTL)
+        return user
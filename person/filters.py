@@ -0,0 +1,28 @@
+from dateutil.relativedelta import relativedelta
+from django.utils.timezone import now
+from django.contrib.auth import get_user_model
+from django_filters import rest_framework as filters
+
+
+class PersonFilter(filters.FilterSet):
+    first_name = filters.CharFilter("first_name", "contains")
+    last_name  = filters.CharFilter("last_name",  "contains")
+    max_age    = filters.NumberFilter(method="filter_max_age")
+    min_age    = filters.NumberFilter(method="filter_min_age")
+
+    class Meta:
+        model = get_user_model()
+        fields = ["first_name", "last_name", "max_age", "min_age"]
+
+    def filter_max_age(self, query_set, name, value):
+        min_date_of_birth = now().date() - relativedelta(years=(value + 1))
+        return query_set.filter(date_of_birth__gt=min_date_of_birth)
+    
+    def filter_min_age(self, query_set, name, value):
+        max_date_of_birth = now().date() - relativedelta(years=value)
+        return query_set.filter(date_of_birth__lte=max_date_of_birth)
+
+
+def get_filter_values(filterset):
+    # Only the filters the request actually set, filterset must be valid
+    return {name: value for name, value in filterset.form.cleaned_data.items() if value not in (None, '')}
@@ -0,0 +1,208 @@
+import csv
+import json
+import os
+import secrets
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX, make_password
+from django.db import IntegrityError, connection, transaction
+from rest_framework.exceptions import ValidationError
+from rest_framework.validators import UniqueValidator
+from person import stats
+from person.backends import forget_users
+from person.serializers import PersonSerializer
+
+
+CSV = 'csv'
+NDJSON = 'ndjson'
+FORMAT_EXTENSIONS = {'.csv': CSV, '.ndjson': NDJSON, '.jsonl': NDJSON}
+IMPORT_FIELDS = ['username', 'password', 'first_name', 'last_name',
+                 'email', 'phone', 'date_of_birth', 'is_staff']
+
+
+def detect_format(file_name):
+    return FORMAT_EXTENSIONS.get(os.path.splitext(file_name)[1].lower())
+
+
+def count_lines(path):
+    with open(path, 'rb') as f:
+        return sum(block.count(b'\n') for block in iter(lambda: f.read(1 << 20), b''))
+
+
+class RecordReader:
+    # Streams (line, data, errors) records from a binary file. `offset` is the
+    # byte position after the last record read, so reading can resume from it.
+
+    def __init__(self, file, file_format, offset=0, line=0):
+        self.file = file
+        self.format = file_format
+        self.offset = offset
+        self.line = line
+        if file_format == CSV:
+            file.seek(0)
+            self.header = next(csv.reader([file.readline().decode('utf-8-sig')]), [])
+            if not offset:
+                self.offset = file.tell()
+                self.line = 1
+        file.seek(self.offset)
+
+    def __iter__(self):
+        if self.format == CSV:
+            return self.read_csv()
+        return self.read_ndjson()
+
+    def read_lines(self):
+        for raw in iter(self.file.readline, b''):
+            self.line += 1
+            yield raw.decode('utf-8', errors='replace')
+
+    def read_csv(self):
+        reader = csv.reader(self.read_lines())
+        while True:
+            start = self.line + 1
+            values = next(reader, None)
+            if values is None:
+                return
+            self.offset = self.file.tell()
+            if not values:
+                continue
+            if len(values) != len(self.header):
+                yield start, None, {'non_field_errors': [f'Expected {len(self.header)} columns, got {len(values)}.']}
+            elif any('\ufffd' in value for value in values):
+                yield start, None, {'non_field_errors': ['Invalid UTF-8 data.']}
+            else:
+                yield start, dict(zip(self.header, values)), None
+
+    def read_ndjson(self):
+        for raw in iter(self.file.readline, b''):
+            self.line += 1
+            self.offset = self.file.tell()
+            if not raw.strip():
+                continue
+            try:
+                data = json.loads(raw)
+            except ValueError as e:
+                yield self.line, None, {'non_field_errors': [f'Invalid JSON: {e}']}
+                continue
+            if not isinstance(data, dict):
+                yield self.line, None, {'non_field_errors': ['Expected a JSON object.']}
+            else:
+                yield self.line, data, None
+
+
+def get_import_fields():
+    # The serializer's own fields carry the model validators (phone_regex,
+    # max lengths, username and email rules), so imports share them
+    fields = PersonSerializer().fields
+    import_fields = {name: fields[name] for name in IMPORT_FIELDS}
+    # Existing usernames are updated rather than rejected
+    username = import_fields['username']
+    username.validators = [v for v in username.validators if not isinstance(v, UniqueValidator)]
+    return import_fields
+
+
+def validate_record(fields, data):
+    values, errors = {}, {}
+    for name, value in data.items():
+        field = fields.get(name)
+        if field is None:
+            continue
+        if value == '' and field.allow_null:
+            # CSV has no null, an empty cell clears a nullable field
+            value = None
+        elif value == '' and not getattr(field, 'allow_blank', False):
+            # Columns that cannot be blank, like password or is_staff, are left unchanged
+            continue
+        try:
+            values[name] = field.run_validation(value)
+        except ValidationError as e:
+            errors[name] = e.detail
+    if 'username' not in values and 'username' not in errors:
+        errors['username'] = ['This field is required.']
+    if 'password' in values and not errors:
+        values['password'] = make_password(values['password'])
+    return values, errors
+
+
+def update_rows(model, field_names, instances):
+    # One prepared UPDATE run with executemany, bulk_update() builds a
+    # CASE WHEN per row and field and is orders of magnitude slower here.
+    # The version is bumped like any other person write.
+    fields = [model._meta.get_field(name) for name in field_names]
+    quote = connection.ops.quote_name
+    version = quote(model._meta.get_field('version').column)
+    sql = 'UPDATE {} SET {}, {} = {} + 1 WHERE {} = %s'.format(
+        quote(model._meta.db_table),
+        ', '.join(f'{quote(field.column)} = %s' for field in fields),
+        version, version,
+        quote(model._meta.pk.column),
+    )
+    params = [[field.get_db_prep_save(getattr(instance, field.attname), connection) for field in fields]
+              + [instance.pk] for instance in instances]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+def import_batch(records, fields=None):
+    # Validates a batch of records, then upserts the valid ones by username
+    # with one lookup query and bulk writes inside a single transaction
+    return write_batch(*validate_batch(records, fields))
+
+
+def validate_batch(records, fields=None, heartbeat=None):
+    # Hashing passwords makes this the slow half of an import, `heartbeat`
+    # is called after every record so a job can report it is still alive
+    fields = fields or get_import_fields()
+    valid, errors = {}, []
+    for line, data, record_errors in records:
+        if not record_errors:
+            data, record_errors = validate_record(fields, data)
+        if record_errors:
+            errors.append({'line': line, 'errors': record_errors})
+        else:
+            # A later line for the same username wins
+            valid[data['username']] = (line, data)
+        if heartbeat is not None:
+            heartbeat()
+    return valid, errors
+
+
+def write_batch(valid, errors):
+    result = {'created': 0, 'updated': 0, 'errors': errors}
+    person_model = get_user_model()
+    existing = person_model.objects.in_bulk(list(valid), field_name='username')
+    to_create, to_update = [], {}
+    for username, (line, data) in valid.items():
+        person = existing.get(username)
+        if person is None:
+            # Same as make_password(None), without its slow per-character random string
+            data.setdefault('password', UNUSABLE_PASSWORD_PREFIX + secrets.token_hex(20))
+            to_create.append(person_model(**data))
+            continue
+        if not person.is_active:
+            # Importing a deleted or deactivated person brings them back
+            data.update(is_active=True, deleted_at=None)
+        changed = tuple(sorted(name for name, value in data.items() if getattr(person, name) != value))
+        for name in changed:
+            setattr(person, name, data[name])
+        to_update.setdefault(changed, []).append(person)
+    # Unchanged rows are counted as updated but not written
+    to_update.pop((), None)
+
+    try:
+        with transaction.atomic():
+            person_model.objects.bulk_create(to_create)
+            for changed_fields, persons in to_update.items():
+                update_rows(person_model, changed_fields, persons)
+    except IntegrityError as e:
+        # e.g. a username created concurrently by another import
+        result['errors'].extend({'line': line, 'errors': {'non_field_errors': [str(e)]}}
+                                for line, _ in valid.values())
+    else:
+        result['created'] = len(to_create)
+        result['updated'] = len(valid) - len(to_create)
+    if valid:
+        # Bulk writes send no signals
+        stats.bump_generation()
+        forget_users([person.pk for persons in to_update.values() for person in persons])
+    result['errors'].sort(key=lambda error: error['line'])
+    return result
@@ -0,0 +1,201 @@
+import json
+import os
+import socket
+from datetime import timedelta
+from itertools import islice
+from pathlib import Path
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.contrib.auth import get_user_model
+from django.utils.timezone import now
+from person import importer, stats
+from person.backends import forget_users
+from person.filters import PersonFilter, get_filter_values
+from person.models import PersonJob
+
+
+CHUNK_SIZE = getattr(settings, 'PERSON_JOB_CHUNK_SIZE', 500)
+# A running job not updated for this many seconds is assumed to have lost its worker
+STALE_TIMEOUT = getattr(settings, 'PERSON_JOB_STALE_TIMEOUT', 300)
+# How often a running job refreshes updated_at while a chunk is in progress
+HEARTBEAT_INTERVAL = STALE_TIMEOUT / 5
+JOB_DIR = getattr(settings, 'PERSON_JOB_DIR', settings.BASE_DIR / 'jobs')
+MAX_REPORTED_ERRORS = 1000
+EXPORT_FIELDS = ['id', 'username', 'first_name', 'last_name', 'email', 'phone', 'date_of_birth', 'is_staff']
+
+
+PROGRESS_FIELDS = ['status', 'cursor', 'processed', 'total', 'result', 'error', 'finished_at', 'updated_at']
+
+
+class JobLost(Exception):
+    # The job was reclaimed by another worker, this one must stop touching it
+    pass
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def filter_persons(params, require_filters=False):
+    filterset = PersonFilter(params.get('filters', {}), queryset=get_user_model().active.all())
+    if not filterset.is_valid():
+        raise ValueError(filterset.errors)
+    if require_filters and not get_filter_values(filterset) and params.get('all') is not True:
+        raise ValueError('No filters given and "all" is not set.')
+    return filterset.qs
+
+
+def upload_path(job):
+    # Only files saved by PersonViewSet.import_persons are read or removed
+    path = Path(job.params['path']).resolve()
+    if path.parent != Path(JOB_DIR).resolve() or job.params.get('format') not in (importer.CSV, importer.NDJSON):
+        raise ValueError('The import file is not in the job directory.')
+    return path
+
+
+def export_path(job):
+    return Path(JOB_DIR) / f'person-export-{job.pk}.ndjson'
+
+
+def claim_job(worker):
+    # Pending jobs first, then running jobs abandoned by a dead worker
+    stale = now() - timedelta(seconds=STALE_TIMEOUT)
+    candidates = (
+        PersonJob.objects
+        .filter(Q(status=PersonJob.PENDING) | Q(status=PersonJob.RUNNING, updated_at__lt=stale))
+        .order_by('id').values_list('id', 'status', 'updated_at')[:10]
+    )
+    for pk, status, updated_at in candidates:
+        # Conditional update, only one worker can win a given job
+        claimed = PersonJob.objects.filter(pk=pk, status=status, updated_at=updated_at).update(
+            status=PersonJob.RUNNING, worker=worker, updated_at=now())
+        if claimed:
+            return PersonJob.objects.get(pk=pk)
+    return None
+
+
+def save_job(job, fields=PROGRESS_FIELDS):
+    # Only the worker that owns the job may write its progress
+    job.updated_at = now()
+    saved = PersonJob.objects.filter(pk=job.pk, worker=job.worker, status=PersonJob.RUNNING).update(
+        **{name: getattr(job, name) for name in fields})
+    if not saved:
+        raise JobLost(job.pk)
+
+
+def heartbeat(job):
+    # Keeps a long chunk from looking abandoned to claim_job()
+    if now() - job.updated_at >= timedelta(seconds=HEARTBEAT_INTERVAL):
+        save_job(job, ['updated_at'])
+
+
+def run_job(job, chunk_size=CHUNK_SIZE):
+    # Each handler call processes one chunk and persists the cursor with it,
+    # so a job picked up again after a crash continues where it stopped
+    handler = HANDLERS[job.kind]
+    try:
+        while handler(job, chunk_size):
+            pass
+    except JobLost:
+        return job
+    except Exception as e:
+        job.status = PersonJob.FAILED
+        job.error = str(e)
+    else:
+        job.status = PersonJob.DONE
+    job.finished_at = now()
+    # Inline import rows may hold plaintext passwords, drop them once used
+    job.params.pop('rows', None)
+    if job.kind == PersonJob.IMPORT and 'path' in job.params:
+        # Uploaded import files are not kept either
+        try:
+            os.remove(upload_path(job))
+        except (FileNotFoundError, ValueError):
+            pass
+    try:
+        save_job(job, PROGRESS_FIELDS + ['params'])
+    except JobLost:
+        pass
+    return job
+
+
+def run_import_chunk(job, chunk_size):
+    # Rows come either inline in params or from an uploaded file, whose
+    # cursor is the byte offset after the last imported record
+    path = job.params.get('path')
+    if path is None:
+        rows = job.params.get('rows', [])
+        records = [(index, row, None) for index, row in enumerate(rows[job.cursor:job.cursor + chunk_size],
+                                                                     start=job.cursor + 1)]
+        job.total = len(rows)
+        cursor = job.cursor + len(records)
+    else:
+        path = upload_path(job)
+        if job.total is None:
+            job.total = importer.count_lines(path) - (job.params['format'] == importer.CSV)
+        with open(path, 'rb') as f:
+            reader = importer.RecordReader(f, job.params['format'], job.cursor, job.result.get('line', 0))
+            records = list(islice(reader, chunk_size))
+        job.result['line'] = reader.line
+        cursor = reader.offset
+
+    valid, record_errors = importer.validate_batch(records, heartbeat=lambda: heartbeat(job))
+    with transaction.atomic():
+        report = importer.write_batch(valid, record_errors)
+        errors = job.result.setdefault('errors', [])
+        errors.extend(report['errors'][:MAX_REPORTED_ERRORS - len(errors)])
+        job.result['created'] = job.result.get('created', 0) + report['created']
+        job.result['updated'] = job.result.get('updated', 0) + report['updated']
+        job.cursor = cursor
+        job.processed += len(records)
+        save_job(job)
+    return len(records) == chunk_size
+
+
+def run_export_chunk(job, chunk_size):
+    query_set = filter_persons(job.params)
+    if job.total is None:
+        job.total = query_set.count()
+    path = export_path(job)
+    written = job.result.get('bytes', 0)
+    os.makedirs(JOB_DIR, exist_ok=True)
+    with open(path, 'ab') as f:
+        # Drop whatever a crashed worker appended after the last saved cursor
+        f.truncate(written)
+        rows = list(query_set.filter(id__gt=job.cursor).order_by('id').values(*EXPORT_FIELDS)[:chunk_size])
+        for row in rows:
+            written += f.write(json.dumps(row, default=str).encode() + b'\n')
+    if rows:
+        job.cursor = rows[-1]['id']
+        job.processed += len(rows)
+    job.result['bytes'] = written
+    save_job(job)
+    return len(rows) == chunk_size
+
+
+def run_delete_chunk(job, chunk_size):
+    query_set = filter_persons(job.params, require_filters=True)
+    if job.total is None:
+        job.total = query_set.count()
+    ids = list(query_set.filter(id__gt=job.cursor).order_by('id').values_list('id', flat=True)[:chunk_size])
+    with transaction.atomic():
+        # Soft delete like PersonViewSet.destroy, `manage.py archive_persons` removes the rows later
+        get_user_model().objects.filter(id__in=ids).update(
+            is_active=False, deleted_at=now(), version=F('version') + 1)
+        if ids:
+            job.cursor = ids[-1]
+            job.processed += len(ids)
+        save_job(job)
+    if ids:
+        # Queryset updates send no signals
+        stats.bump_generation()
+        forget_users(ids)
+    return len(ids) == chunk_size
+
+
+HANDLERS = {
+    PersonJob.IMPORT: run_import_chunk,
+    PersonJob.EXPORT: run_export_chunk,
+    PersonJob.DELETE: run_delete_chunk,
+}
@@ -0,0 +1,22 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from person import archive
+
+
+class Command(BaseCommand):
+    help = 'Move persons inactive for longer than --days from the person table to the archive table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365)
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Only count the persons to archive.')
+
+    def handle(self, *args, **options):
+        cutoff = now() - timedelta(days=options['days'])
+        if options['dry_run']:
+            count = archive.archivable_persons(cutoff).count()
+            self.stdout.write(f'{count} persons would be archived')
+            return
+        count = archive.archive_persons(cutoff, options['chunk_size'])
+        self.stdout.write(f'{count} persons archived')
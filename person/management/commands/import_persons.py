@@ -0,0 +1,37 @@
+import time
+from itertools import islice
+from django.core.management.base import BaseCommand, CommandError
+from person import importer
+
+
+class Command(BaseCommand):
+    help = 'Import persons from a CSV or NDJSON file, upserting by username.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=[importer.CSV, importer.NDJSON],
+                            help='File format, detected from the extension by default.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Records validated and written per transaction.')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or importer.detect_format(options['path'])
+        if file_format is None:
+            raise CommandError('Cannot detect the file format, use --format.')
+        fields = importer.get_import_fields()
+        created = updated = failed = records = 0
+        start = time.monotonic()
+        with open(options['path'], 'rb') as f:
+            reader = iter(importer.RecordReader(f, file_format))
+            while chunk := list(islice(reader, options['chunk_size'])):
+                report = importer.import_batch(chunk, fields)
+                for error in report['errors']:
+                    self.stderr.write(f"line {error['line']}: {error['errors']}")
+                records += len(chunk)
+                created += report['created']
+                updated += report['updated']
+                failed += len(report['errors'])
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            f'{records} records in {elapsed:.1f}s ({records / max(elapsed, 1e-9):.0f}/s): '
+            f'{created} created, {updated} updated, {failed} failed')
@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+from person import jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued person import/export/delete jobs. Start several to process jobs in parallel.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Exit when no job is pending.')
+        parser.add_argument('--sleep', type=float, default=2.0, help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--chunk-size', type=int, default=jobs.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        worker = jobs.worker_name()
+        while True:
+            job = jobs.claim_job(worker)
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+                continue
+            self.stdout.write(f'Running {job.kind} job {job.pk}')
+            job = jobs.run_job(job, options['chunk_size'])
+            self.stdout.write(f'Job {job.pk} {job.status} ({job.processed} processed)')
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('person', '0007_soft_delete_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -1,12 +1,26 @@
 from django.db import models
 from django.utils import timezone
 from django.core.validators import RegexValidator
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager
+
+
+class ActivePersonManager(models.Manager):
+    # Live persons only, the partial indexes below cover this queryset
+    def get_queryset(self):
+        return super().get_queryset().filter(is_active=True)
 
 
 class Person(AbstractUser):
     # AbstractUser has fields [username, password, first_name, last_name, email, is_staff(admin)]
-    
+
+    # `objects` stays the default manager so auth and username uniqueness see every row
+    objects = UserManager()
+    active = ActivePersonManager()
+
+    deleted_at = models.DateTimeField(blank=True, null=True)
+    # Bumped by save() except for last_login-only saves, and by the bulk
+    # writes in person.importer and person.jobs. Exposed as the ETag for If-Match.
+    version = models.PositiveIntegerField(default=1)
     date_of_birth = models.DateField(blank=True, null=True)
     phone_regex = RegexValidator(
         regex=r"^\+?\d{8,15}$",
@@ -26,5 +40,87 @@ class Person(AbstractUser):
             age -= 1
         return age
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        # A login only updates last_login, that is not an edit of the person
+        if self._state.adding or (update_fields is not None and not set(update_fields) - {'last_login'}):
+            return super().save(*args, **kwargs)
+        self.version = models.F('version') + 1
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'version'}
+        super().save(*args, **kwargs)
+        self.refresh_from_db(fields=['version'])
+
+    def soft_delete(self):
+        self.is_active = False
+        self.deleted_at = timezone.now()
+        self.save(update_fields=['is_active', 'deleted_at'])
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(is_active=True), name='person_active_id_idx'),
+            models.Index(fields=['date_of_birth'], condition=models.Q(is_active=True), name='person_active_dob_idx'),
+        ]
+
+
+class ArchivedPerson(models.Model):
+    # Long-inactive persons moved out of the person table by `manage.py archive_persons`
+    original_id = models.BigIntegerField(db_index=True)
+    username = models.CharField(max_length=150, db_index=True)
+    password = models.CharField(max_length=128)
+    first_name = models.CharField(max_length=150, blank=True)
+    last_name = models.CharField(max_length=150, blank=True)
+    email = models.EmailField(blank=True)
+    phone = models.CharField(max_length=16, blank=True)
+    date_of_birth = models.DateField(blank=True, null=True)
+    is_staff = models.BooleanField(default=False)
+    date_joined = models.DateTimeField()
+    last_login = models.DateTimeField(blank=True, null=True)
+    deleted_at = models.DateTimeField(blank=True, null=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+
+class PersonJob(models.Model):
+    # Heavy person operations run by `manage.py run_person_jobs` workers
+    # outside the request cycle, processed in chunks and resumable from cursor
+
+    IMPORT = 'import'
+    EXPORT = 'export'
+    DELETE = 'delete'
+    KIND_CHOICES = [(IMPORT, 'Import'), (EXPORT, 'Export'), (DELETE, 'Delete')]
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    params = models.JSONField(default=dict, blank=True)
+    # Position to resume from: last processed person id, or row index for imports
+    cursor = models.BigIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(blank=True, null=True)
+    result = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=128, blank=True)
+    created_by = models.ForeignKey(Person, blank=True, null=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def get_progress(self):
+        if self.status == self.DONE:
+            return 100.0
+        if not self.total:
+            return 0.0
+        return min(round(100.0 * self.processed / self.total, 1), 100.0)
+
     class Meta:
         ordering = ['id']
+        indexes = [models.Index(fields=['status', 'id'])]
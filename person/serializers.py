@@ -1,6 +1,11 @@
 from rest_framework import serializers
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save
+from django.db.models import F
+from person.exceptions import PreconditionFailed
+from person.filters import PersonFilter, get_filter_values
+from person.models import PersonJob
 
 
 age_field = serializers.ReadOnlyField(source='get_age')
@@ -14,10 +19,35 @@ class PersonSerializer(serializers.HyperlinkedModelSerializer):
     # Hash password
     def validate_password(self, value):
         return make_password(value)
-    
+
+    def update(self, instance, validated_data):
+        # One conditional UPDATE writes only the changed columns, bumps the
+        # version and does the If-Match comparison
+        expected_version = self.context.get('expected_version')
+        if expected_version is not None and expected_version != instance.version:
+            raise PreconditionFailed()
+        changed = {name: value for name, value in validated_data.items() if getattr(instance, name) != value}
+        rows = get_user_model().objects.filter(pk=instance.pk)
+        if expected_version is not None:
+            rows = rows.filter(version=expected_version)
+        if not changed:
+            if not rows.exists():
+                raise PreconditionFailed()
+            return instance
+        if not rows.update(**changed, version=F('version') + 1):
+            raise PreconditionFailed()
+        for name, value in changed.items():
+            setattr(instance, name, value)
+        instance.refresh_from_db(fields=['version'])
+        # The UPDATE bypasses save(), signal it so the stats and user caches are invalidated
+        post_save.send(sender=type(instance), instance=instance, created=False, raw=False,
+                       using=rows.db, update_fields=frozenset([*changed, 'version']))
+        return instance
+
     class Meta:
         model = get_user_model()
-        fields = filter_person_fields + ['username', 'password', 'is_staff']
+        fields = filter_person_fields + ['username', 'password', 'is_staff', 'version']
+        read_only_fields = ['version']
     
 
 class FilterPersonSerializer(serializers.HyperlinkedModelSerializer):
@@ -25,4 +55,94 @@ class FilterPersonSerializer(serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = get_user_model()
-        fields = filter_person_fields
\ No newline at end of file
+        fields = filter_person_fields
+
+
+BATCH_LOOKUP_MAX = 5000
+
+
+class BatchLookupSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1, max_value=2 ** 63 - 1), required=False, max_length=BATCH_LOOKUP_MAX)
+    usernames = serializers.ListField(child=serializers.CharField(), required=False, max_length=BATCH_LOOKUP_MAX)
+
+    def validate(self, attrs):
+        if len(attrs) != 1:
+            raise serializers.ValidationError(f'Provide exactly one of: {", ".join(self.fields)}.')
+        return attrs
+
+
+class FilterBatchLookupSerializer(BatchLookupSerializer):
+    # Guests cannot see usernames, so they cannot look persons up by them either
+    usernames = None
+
+
+class BatchLookupResultSerializer(serializers.Serializer):
+    # Documents the response of PersonViewSet.batch
+    results = PersonSerializer(many=True)
+    missing = serializers.ListField(child=serializers.JSONField(), help_text='Requested ids or usernames not found.')
+
+
+class FilterBatchLookupResultSerializer(BatchLookupResultSerializer):
+    results = FilterPersonSerializer(many=True)
+
+
+IMPORT_ROWS_MAX = 10000
+
+
+class PersonJobSerializer(serializers.HyperlinkedModelSerializer):
+    HIDDEN_PARAMS = ['rows', 'path']
+    # File imports get their path and format from PersonViewSet.import_persons,
+    # never from the client
+    ALLOWED_PARAMS = {
+        PersonJob.IMPORT: {'rows'},
+        PersonJob.EXPORT: {'filters'},
+        PersonJob.DELETE: {'filters', 'all'},
+    }
+
+    progress = serializers.ReadOnlyField(source='get_progress')
+
+    def validate(self, attrs):
+        try:
+            params = serializers.DictField().run_validation(attrs.get('params', {}))
+        except serializers.ValidationError as e:
+            raise serializers.ValidationError({'params': e.detail})
+        unknown = sorted(set(params) - self.ALLOWED_PARAMS[attrs['kind']])
+        if unknown:
+            raise serializers.ValidationError({'params': f'Unknown params: {", ".join(unknown)}.'})
+        if attrs['kind'] == PersonJob.IMPORT:
+            if 'rows' not in params:
+                raise serializers.ValidationError({'params': 'Import jobs require a list of "rows".'})
+            # Larger imports go through file upload, see PersonViewSet.import_persons
+            rows_field = serializers.ListField(child=serializers.DictField(), max_length=IMPORT_ROWS_MAX)
+            try:
+                rows_field.run_validation(params['rows'])
+            except serializers.ValidationError as e:
+                raise serializers.ValidationError({'params': {'rows': e.detail}})
+        else:
+            try:
+                filters = serializers.DictField().run_validation(params.get('filters', {}))
+            except serializers.ValidationError as e:
+                raise serializers.ValidationError({'params': {'filters': e.detail}})
+            filterset = PersonFilter(filters, queryset=get_user_model().objects.none())
+            if not filterset.is_valid():
+                raise serializers.ValidationError({'params': filterset.errors})
+            if attrs['kind'] == PersonJob.DELETE and not get_filter_values(filterset) and params.get('all') is not True:
+                raise serializers.ValidationError(
+                    {'params': 'Delete jobs require "filters", or "all": true to delete every person.'})
+        return attrs
+
+    def to_representation(self, instance):
+        # Import rows may hold plaintext passwords, never send them back
+        data = super().to_representation(instance)
+        data['params'] = {name: value for name, value in data['params'].items() if name not in self.HIDDEN_PARAMS}
+        # Server paths are not part of the API, exports are fetched from the download action
+        data['result'].pop('path', None)
+        return data
+
+    class Meta:
+        model = PersonJob
+        fields = ['url', 'id', 'kind', 'status', 'params', 'processed', 'total', 'progress',
+                  'result', 'error', 'created_at', 'updated_at', 'finished_at']
+        read_only_fields = ['status', 'processed', 'total', 'result', 'error',
+                            'created_at', 'updated_at', 'finished_at']
+        extra_kwargs = {'url': {'view_name': 'person-job-detail'}}
@@ -0,0 +1,27 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.contrib.auth import get_user_model
+from django.contrib.auth.signals import user_logged_out
+from person import stats
+from person.backends import forget_users
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def invalidate_stats(sender, update_fields=None, **kwargs):
+    # Logins only touch last_login, which no stat depends on
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    stats.bump_generation()
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def invalidate_cached_user(sender, instance, **kwargs):
+    forget_users([instance.pk])
+
+
+@receiver(user_logged_out)
+def forget_logged_out_user(sender, request, user, **kwargs):
+    if user is not None:
+        forget_users([user.pk])
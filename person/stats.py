@@ -0,0 +1,85 @@
+import hashlib
+import json
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, Count, IntegerField, Value, When
+from django.db.models.functions import ExtractYear, Lower, StrIndex, Substr
+from django.utils.timezone import now
+
+
+# Upper bound (exclusive) of each age band; the last band is open-ended
+AGE_BANDS = [(18, '0-17'), (30, '18-29'), (45, '30-44'), (65, '45-64'), (None, '65+')]
+UNKNOWN = 'unknown'
+
+GENERATION_KEY = 'person:stats:generation'
+STATS_CACHE_TIMEOUT = getattr(settings, 'PERSON_STATS_CACHE_TIMEOUT', 3600)
+
+
+def get_generation():
+    return cache.get_or_set(GENERATION_KEY, 0, timeout=None)
+
+
+def bump_generation():
+    # Every write to persons moves the generation forward, which orphans
+    # all cached stats computed before it
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.add(GENERATION_KEY, 1, timeout=None)
+
+
+def age_band_expression(today):
+    whens = []
+    for upper, label in AGE_BANDS:
+        if upper is None:
+            whens.append(When(date_of_birth__isnull=False, then=Value(label)))
+        else:
+            # Younger than `upper` means born after this date
+            whens.append(When(date_of_birth__gt=today - relativedelta(years=upper), then=Value(label)))
+    return Case(*whens, default=Value(UNKNOWN))
+
+
+def email_domain_expression():
+    return Lower(Substr('email', StrIndex('email', Value('@')) + 1))
+
+
+def compute_stats(query_set):
+    # Grouping happens in SQL, only one row per group comes back
+    today = now().date()
+    query_set = query_set.order_by()
+    age_bands = dict(
+        query_set.annotate(band=age_band_expression(today))
+        .values_list('band').annotate(count=Count('id'))
+    )
+    birth_years = (
+        query_set.filter(date_of_birth__isnull=False)
+        .annotate(year=ExtractYear('date_of_birth', output_field=IntegerField()))
+        .values('year').annotate(count=Count('id')).order_by('year')
+    )
+    email_domains = (
+        query_set.filter(email__contains='@')
+        .annotate(domain=email_domain_expression())
+        .values('domain').annotate(count=Count('id')).order_by('-count', 'domain')
+    )
+    labels = [label for _, label in AGE_BANDS] + [UNKNOWN]
+    return {
+        'count': sum(age_bands.values()),
+        'age_bands': [{'band': label, 'count': age_bands.get(label, 0)} for label in labels],
+        'birth_years': list(birth_years),
+        'email_domains': list(email_domains),
+    }
+
+
+def get_stats(query_set, params):
+    # Age bands depend on today's date, so the date is part of the key too
+    # JSON keeps names and values apart, whatever characters they contain
+    key_params = json.dumps(sorted((name, value) for name, value in params.items() if value not in (None, '')),
+                            default=str)
+    digest = hashlib.md5(key_params.encode()).hexdigest()
+    key = f'person:stats:{get_generation()}:{now().date().isoformat()}:{digest}'
+    stats = cache.get(key)
+    if stats is None:
+        stats = compute_stats(query_set)
+        cache.set(key, stats, timeout=STATS_CACHE_TIMEOUT)
+    return stats
@@ -5,7 +5,24 @@ from django.core.exceptions import ValidationError
 from rest_framework.test import APIClient
 from rest_framework import status
 from person.serializers import FilterPersonSerializer, PersonSerializer
-from datetime import date
+from person.models import PersonJob, ArchivedPerson
+from django.utils.timezone import now
+from person import importer, jobs
+from itertools import islice
+from django.core.management import call_command
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from person.backends import USER_CACHE_ALIAS, user_cache_key
+from person.stats import get_generation
+from person.exceptions import PreconditionFailed
+from django.core.files.uploadedfile import SimpleUploadedFile
+from unittest import mock
+from io import StringIO
+import json
+import tempfile
+from pathlib import Path
+from datetime import date, timedelta
 from pprint import pprint
 
 
@@ -190,7 +207,14 @@ class PersonViewSetTestCase(TestCaseWithUsers):
         delete_url = reverse('person-detail', args=[self.guest_user.pk])
         response = self.client.delete(delete_url)
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
-        self.assertEqual(user_model.objects.count(), 1)
+        # Soft deleted, the row stays until it is archived
+        self.assertEqual(user_model.active.count(), 1)
+        self.assertEqual(user_model.objects.count(), 2)
+        self.guest_user.refresh_from_db()
+        self.assertFalse(self.guest_user.is_active)
+        self.assertIsNotNone(self.guest_user.deleted_at)
+        response = self.client.get(delete_url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_regular_user_access(self):
         # Test that regular users can't perform CRUD operations
@@ -335,3 +359,535 @@ class PaginationTestCase(TestCaseWithUsers):
         pprint(response.json())
         self.assertEqual(response.json()['count'], 3)
         self.assertIn('?page=2', response.json()['next'])
+
+
+class StatsTestCase(TestCaseWithUsers):
+    def test_stats(self):
+        user_model.objects.create(username='user1', first_name='John', last_name='Doe',
+                                  email='john@Other.org', date_of_birth=date(1990, 1, 1))
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.get(reverse('person-stats'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(sum(band['count'] for band in data['age_bands']), 3)
+        self.assertEqual(data['birth_years'], [{'year': 1990, 'count': 1},
+                                               {'year': 2000, 'count': 1},
+                                               {'year': 2001, 'count': 1}])
+        self.assertEqual(data['email_domains'], [{'domain': 'example.com', 'count': 2},
+                                                 {'domain': 'other.org', 'count': 1}])
+
+    def test_stats_with_filter(self):
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.get(reverse('person-stats'), {'first_name': 'Guest'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['count'], 1)
+        self.assertEqual(response.json()['birth_years'], [{'year': 2001, 'count': 1}])
+
+    def test_stats_invalid_filter(self):
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.get(reverse('person-stats'), {'min_age': 'abc'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('min_age', response.json())
+
+    def test_stats_cached_and_invalidated(self):
+        self.client.force_authenticate(user=self.admin_user)
+        self.client.get(reverse('person-stats'))
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('person-stats'))
+        self.assertEqual(response.json()['count'], 2)
+        # Only cache reads, no aggregate query on persons
+        self.assertFalse(any('person_person' in query['sql'] for query in context.captured_queries))
+
+        user_model.objects.create(username='user1', first_name='John', last_name='Doe')
+        response = self.client.get(reverse('person-stats'))
+        self.assertEqual(response.json()['count'], 3)
+
+    def test_stats_cache_keys_distinct(self):
+        user_model.objects.create(username='user1', first_name='a', last_name='b', date_of_birth=date(1990, 1, 1))
+        user_model.objects.create(username='user2', first_name='a&last_name=b')
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.get(reverse('person-stats'), {'first_name': 'a', 'last_name': 'b'})
+        self.assertEqual(response.json()['count'], 1)
+        response = self.client.get(reverse('person-stats'), {'first_name': 'a&last_name=b'})
+        self.assertEqual(response.json()['count'], 1)
+        self.assertEqual(response.json()['birth_years'], [])
+
+    def test_login_keeps_stats_cached(self):
+        generation = get_generation()
+        self.assertTrue(self.client.login(username='guest', password='guest123'))
+        self.assertEqual(get_generation(), generation)
+
+    def test_stats_guest_forbidden(self):
+        self.client.force_authenticate(user=self.guest_user)
+        response = self.client.get(reverse('person-stats'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class PersonJobTestCase(TestCaseWithUsers):
+    def run_workers(self):
+        call_command('run_person_jobs', '--once', '--chunk-size', '2', stdout=StringIO())
+
+    def test_guest_forbidden(self):
+        self.client.force_authenticate(user=self.guest_user)
+        response = self.client.post(reverse('person-job-list'), {'kind': 'export'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_invalid_params(self):
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.post(reverse('person-job-list'),
+                                    {'kind': 'delete', 'params': {'filters': {'min_age': 'abc'}}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('person-job-list'), {'kind': 'import'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        for params in [[1], 'x', {'filters': [1]}, {'filters': 'abc'}]:
+            response = self.client.post(reverse('person-job-list'), {'kind': 'export', 'params': params}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn('params', response.json())
+        for rows in [[1, 'x'], 'x', [{}] * 10001]:
+            response = self.client.post(reverse('person-job-list'),
+                                        {'kind': 'import', 'params': {'rows': rows}}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_delete_job_requires_filters(self):
+        self.client.force_authenticate(user=self.admin_user)
+        for params in [{}, {'filters': {'first_name': ''}}, {'all': 'yes'}]:
+            response = self.client.post(reverse('person-job-list'), {'kind': 'delete', 'params': params}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('person-job-list'), {'kind': 'delete', 'params': {'all': True}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # Jobs created without the API are checked by the worker too
+        job = PersonJob.objects.create(kind=PersonJob.DELETE)
+        PersonJob.objects.exclude(pk=job.pk).delete()
+        self.run_workers()
+        job.refresh_from_db()
+        self.assertEqual(job.status, PersonJob.FAILED)
+        self.assertEqual(user_model.active.count(), 2)
+
+    def test_file_path_refused(self):
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.post(reverse('person-job-list'),
+                                    {'kind': 'import', 'params': {'rows': [], 'path': '/etc/passwd', 'format': 'csv'}},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # The worker only reads and removes files in the job directory
+        with tempfile.TemporaryDirectory() as job_dir, tempfile.NamedTemporaryFile(suffix='.csv') as f, \
+                mock.patch.object(jobs, 'JOB_DIR', Path(job_dir)):
+            f.write(b'username\nuser1\n')
+            f.flush()
+            job = PersonJob.objects.create(kind=PersonJob.IMPORT, params={'path': f.name, 'format': 'csv'})
+            self.run_workers()
+            job.refresh_from_db()
+            self.assertEqual(job.status, PersonJob.FAILED)
+            self.assertTrue(Path(f.name).exists())
+        self.assertFalse(user_model.objects.filter(username='user1').exists())
+
+    def test_import_job(self):
+        self.client.force_authenticate(user=self.admin_user)
+        rows = [{'username': f'user{i}', 'password': 'password'} for i in range(5)] + [{'username': ''}]
+        response = self.client.post(reverse('person-job-list'),
+                                    {'kind': 'import', 'params': {'rows': rows}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['status'], PersonJob.PENDING)
+
+        self.assertNotIn('rows', response.json()['params'])
+
+        self.run_workers()
+        response = self.client.get(response.json()['url'])
+        self.assertNotIn('rows', response.json()['params'])
+        self.assertNotIn('rows', PersonJob.objects.get(pk=response.json()['id']).params)
+        self.assertEqual(response.json()['status'], PersonJob.DONE)
+        self.assertEqual(response.json()['processed'], 6)
+        self.assertEqual(response.json()['progress'], 100.0)
+        self.assertEqual([error['line'] for error in response.json()['result']['errors']], [6])
+        self.assertEqual(user_model.objects.count(), 7)
+
+    def test_delete_job(self):
+        for i in range(5):
+            user_model.objects.create(username=f'user{i}', first_name='John', last_name='Doe')
+        job = PersonJob.objects.create(kind=PersonJob.DELETE, params={'filters': {'first_name': 'John'}})
+        self.run_workers()
+        job.refresh_from_db()
+        self.assertEqual(job.status, PersonJob.DONE)
+        self.assertEqual(job.total, 5)
+        self.assertEqual(job.processed, 5)
+        self.assertEqual(user_model.active.count(), 2)
+        self.assertEqual(user_model.objects.count(), 7)
+
+    def test_export_job_resumes(self):
+        for i in range(3):
+            user_model.objects.create(username=f'user{i}', first_name='John', last_name='Doe')
+        self.client.force_authenticate(user=self.admin_user)
+        with tempfile.TemporaryDirectory() as job_dir, mock.patch.object(jobs, 'JOB_DIR', Path(job_dir)):
+            job = PersonJob.objects.create(kind=PersonJob.EXPORT, status=PersonJob.RUNNING)
+            # Simulate a worker that died after the first chunk and left a partial line behind
+            jobs.run_export_chunk(job, 2)
+            with open(jobs.export_path(job), 'ab') as f:
+                f.write(b'{"partial')
+            PersonJob.objects.filter(pk=job.pk).update(updated_at=job.updated_at - timedelta(hours=1))
+
+            self.run_workers()
+            job.refresh_from_db()
+            self.assertEqual(job.status, PersonJob.DONE)
+            self.assertEqual(job.processed, 5)
+            self.assertNotIn('path', self.client.get(reverse('person-job-detail', args=[job.pk])).json()['result'])
+            response = self.client.get(reverse('person-job-download', args=[job.pk]))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            lines = b''.join(response.streaming_content).splitlines()
+            response.close()
+        self.assertEqual([json.loads(line)['username'] for line in lines],
+                         ['admin', 'guest', 'user0', 'user1', 'user2'])
+
+    def test_reclaimed_job_stops_old_worker(self):
+        job = PersonJob.objects.create(kind=PersonJob.IMPORT, params={'rows': [{'username': 'user1'}]})
+        stale_job = jobs.claim_job('worker-1')
+        PersonJob.objects.filter(pk=job.pk).update(updated_at=now() - timedelta(hours=1))
+        self.assertEqual(jobs.claim_job('worker-2').pk, job.pk)
+
+        jobs.run_job(stale_job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker, job.cursor), (PersonJob.RUNNING, 'worker-2', 0))
+        self.assertFalse(user_model.objects.filter(username='user1').exists())
+
+    def test_heartbeat(self):
+        PersonJob.objects.create(kind=PersonJob.EXPORT)
+        job = jobs.claim_job('worker-1')
+        job.updated_at -= timedelta(seconds=jobs.HEARTBEAT_INTERVAL)
+        jobs.heartbeat(job)
+        self.assertGreater(PersonJob.objects.get(pk=job.pk).updated_at, now() - timedelta(seconds=5))
+
+        PersonJob.objects.filter(pk=job.pk).update(worker='worker-2')
+        job.updated_at -= timedelta(seconds=jobs.HEARTBEAT_INTERVAL)
+        with self.assertRaises(jobs.JobLost):
+            jobs.heartbeat(job)
+
+    def test_download_missing_export(self):
+        job = PersonJob.objects.create(kind=PersonJob.EXPORT, status=PersonJob.DONE)
+        self.client.force_authenticate(user=self.admin_user)
+        with tempfile.TemporaryDirectory() as job_dir, mock.patch.object(jobs, 'JOB_DIR', Path(job_dir)):
+            response = self.client.get(reverse('person-job-download', args=[job.pk]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_claim_job_once(self):
+        job = PersonJob.objects.create(kind=PersonJob.EXPORT)
+        self.assertEqual(jobs.claim_job('worker-1').pk, job.pk)
+        self.assertIsNone(jobs.claim_job('worker-2'))
+
+
+class ImportTestCase(TestCaseWithUsers):
+    csv_data = (
+        'username,first_name,last_name,email,phone,date_of_birth,is_staff\n'
+        'user1,John,Doe,john@example.com,+1234567890,1990-01-01,false\n'
+        'user2,Jane,Doe,,12345,,false\n'
+        'guest,Changed,User,guest@example.com,0987654321,,false\n'
+        '\n'
+        'user3,"Multi\nLine",Doe,,,2000-01-01,true\n'
+        'user4,Too,Few\n'
+    )
+
+    def test_import_command(self):
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write(self.csv_data.encode())
+            f.flush()
+            stdout, stderr = StringIO(), StringIO()
+            call_command('import_persons', f.name, '--chunk-size', '2', stdout=stdout, stderr=stderr)
+        self.assertIn('5 records', stdout.getvalue())
+        self.assertIn('2 created, 1 updated, 2 failed', stdout.getvalue())
+        self.assertIn('line 3:', stderr.getvalue())
+        self.assertIn('line 8:', stderr.getvalue())
+
+        self.assertFalse(user_model.objects.filter(username='user2').exists())
+        user1 = user_model.objects.get(username='user1')
+        self.assertEqual(user1.date_of_birth, date(1990, 1, 1))
+        self.assertFalse(user1.has_usable_password())
+        self.assertEqual(user_model.objects.get(username='user3').first_name, 'Multi\nLine')
+        self.assertTrue(user_model.objects.get(username='user3').is_staff)
+        guest = user_model.objects.get(username='guest')
+        self.assertEqual(guest.first_name, 'Changed')
+        self.assertIsNone(guest.date_of_birth)
+        # Password is kept when the column is not supplied
+        self.assertTrue(guest.check_password('guest123'))
+
+    def test_blank_cells_not_supplied(self):
+        with tempfile.TemporaryDirectory() as job_dir:
+            path = Path(job_dir) / 'persons.csv'
+            path.write_text('username,password,is_staff,first_name\nuser1,,,\nguest,,,\n')
+            with open(path, 'rb') as f:
+                report = importer.import_batch(list(importer.RecordReader(f, importer.CSV)))
+        self.assertEqual((report['created'], report['updated'], report['errors']), (1, 1, []))
+        self.assertFalse(user_model.objects.get(username='user1').has_usable_password())
+        guest = user_model.objects.get(username='guest')
+        self.assertTrue(guest.check_password('guest123'))
+        # Blank is a valid first name, so it still clears it
+        self.assertEqual(guest.first_name, '')
+
+    def test_import_ndjson(self):
+        records = [
+            '{"username": "user1", "password": "secret123", "phone": "+1234567890"}',
+            'not json',
+            '[1, 2]',
+            '{"first_name": "No username"}',
+            '{"username": "user1", "first_name": "Later"}',
+        ]
+        with tempfile.TemporaryDirectory() as job_dir:
+            path = Path(job_dir) / 'persons.ndjson'
+            path.write_text('\n'.join(records) + '\n')
+            with open(path, 'rb') as f:
+                report = importer.import_batch(list(importer.RecordReader(f, importer.NDJSON)))
+        self.assertEqual(report['created'], 1)
+        self.assertEqual([error['line'] for error in report['errors']], [2, 3, 4])
+        user1 = user_model.objects.get(username='user1')
+        self.assertEqual(user1.first_name, 'Later')
+
+    def test_reader_resumes_from_offset(self):
+        with tempfile.TemporaryDirectory() as job_dir:
+            path = Path(job_dir) / 'persons.csv'
+            path.write_text(self.csv_data)
+            with open(path, 'rb') as f:
+                reader = importer.RecordReader(f, importer.CSV)
+                first = [record[0] for record in islice(reader, 2)]
+                resumed = importer.RecordReader(f, importer.CSV, reader.offset, reader.line)
+                rest = [record[0] for record in resumed]
+        self.assertEqual(first, [2, 3])
+        self.assertEqual(rest, [4, 6, 8])
+
+    def test_upload_endpoint(self):
+        self.client.force_authenticate(user=self.admin_user)
+        with tempfile.TemporaryDirectory() as job_dir, mock.patch.object(jobs, 'JOB_DIR', Path(job_dir)):
+            upload = SimpleUploadedFile('persons.csv', self.csv_data.encode())
+            response = self.client.post(reverse('person-import'), {'file': upload}, format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            call_command('run_person_jobs', '--once', '--chunk-size', '2', stdout=StringIO())
+            response = self.client.get(response.json()['url'])
+            self.assertEqual(list(Path(job_dir).iterdir()), [])
+        result = response.json()['result']
+        self.assertEqual(response.json()['status'], PersonJob.DONE)
+        self.assertEqual(response.json()['processed'], 5)
+        self.assertEqual((result['created'], result['updated']), (2, 1))
+        self.assertEqual([error['line'] for error in result['errors']], [3, 8])
+
+    def test_upload_unsupported_format(self):
+        self.client.force_authenticate(user=self.admin_user)
+        upload = SimpleUploadedFile('persons.txt', b'username\nuser1\n')
+        response = self.client.post(reverse('person-import'), {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SoftDeleteTestCase(TestCaseWithUsers):
+    def test_inactive_hidden_from_filter(self):
+        user_model.objects.create(username='user1', first_name='John', last_name='Doe', is_active=False)
+        self.client.force_authenticate(user=self.guest_user)
+        response = self.client.get(reverse('filter-person-list'), {'first_name': 'John'})
+        self.assertEqual(response.json()['count'], 0)
+
+    def test_soft_deleted_cannot_login(self):
+        self.guest_user.soft_delete()
+        self.assertFalse(self.client.login(username='guest', password='guest123'))
+
+    def test_soft_deleted_username_stays_taken(self):
+        self.guest_user.soft_delete()
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.post(reverse('person-list'), {'username': 'guest', 'password': 'guest123'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_reactivates_deleted(self):
+        self.guest_user.soft_delete()
+        report = importer.import_batch([(1, {'username': 'guest', 'first_name': 'Back'}, None)])
+        self.assertEqual(report['updated'], 1)
+        self.guest_user.refresh_from_db()
+        self.assertTrue(self.guest_user.is_active)
+        self.assertIsNone(self.guest_user.deleted_at)
+        self.assertEqual(self.guest_user.first_name, 'Back')
+
+    def test_archive_persons(self):
+        old = user_model.objects.create(username='old', first_name='Old', phone='1234567890',
+                                        is_active=False, deleted_at=now() - timedelta(days=400))
+        recent = user_model.objects.create(username='recent', is_active=False, deleted_at=now() - timedelta(days=10))
+        never_logged_in = user_model.objects.create(username='never', is_active=False)
+        user_model.objects.filter(pk=never_logged_in.pk).update(date_joined=now() - timedelta(days=500))
+
+        stdout = StringIO()
+        call_command('archive_persons', '--days', '365', '--dry-run', stdout=stdout)
+        self.assertIn('2 persons would be archived', stdout.getvalue())
+        self.assertEqual(ArchivedPerson.objects.count(), 0)
+
+        stdout = StringIO()
+        call_command('archive_persons', '--days', '365', '--chunk-size', '1', stdout=stdout)
+        self.assertIn('2 persons archived', stdout.getvalue())
+        self.assertFalse(user_model.objects.filter(pk__in=[old.pk, never_logged_in.pk]).exists())
+        self.assertTrue(user_model.objects.filter(pk=recent.pk).exists())
+        archived = ArchivedPerson.objects.get(original_id=old.pk)
+        self.assertEqual((archived.username, archived.first_name, archived.phone), ('old', 'Old', '1234567890'))
+        self.assertEqual(archived.password, old.password)
+
+
+class CachedUserTestCase(TestCaseWithUsers):
+    def setUp(self):
+        super().setUp()
+        caches[USER_CACHE_ALIAS].clear()
+        self.client.login(username='guest', password='guest123')
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('filter-person-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_user_lookup_cached(self):
+        # Session, user, count and page queries, then the user comes from cache
+        self.assertEqual(self.count_queries(), 4)
+        self.assertEqual(self.count_queries(), 3)
+
+    def test_invalidated_on_save(self):
+        self.count_queries()
+        self.guest_user.is_staff = True
+        self.guest_user.save()
+        self.assertEqual(self.count_queries(), 4)
+        response = self.client.get(reverse('person-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_soft_deleted_user_rejected(self):
+        self.count_queries()
+        self.guest_user.soft_delete()
+        response = self.client.get(reverse('filter-person-list'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_invalidated_on_logout(self):
+        self.count_queries()
+        self.client.logout()
+        self.assertIsNone(caches[USER_CACHE_ALIAS].get(user_cache_key(self.guest_user.pk)))
+
+
+class BatchLookupTestCase(TestCaseWithUsers):
+    def test_batch_by_ids(self):
+        self.client.force_authenticate(user=self.admin_user)
+        ids = [self.guest_user.pk, 9999, self.admin_user.pk, self.guest_user.pk]
+        response = self.client.post(reverse('person-batch'), {'ids': ids}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([person['username'] for person in response.json()['results']], ['guest', 'admin'])
+        self.assertEqual(response.json()['missing'], [9999])
+
+    def test_batch_by_usernames(self):
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.post(reverse('person-batch'), {'usernames': ['nobody', 'admin']}, format='json')
+        self.assertEqual([person['id'] for person in response.json()['results']], [self.admin_user.pk])
+        self.assertEqual(response.json()['missing'], ['nobody'])
+
+    def test_batch_large(self):
+        user_model.objects.bulk_create([user_model(username=f'user{i}') for i in range(3000)])
+        ids = list(user_model.objects.order_by('-id').values_list('id', flat=True))
+        self.client.force_authenticate(user=self.admin_user)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse('person-batch'), {'ids': ids}, format='json')
+        self.assertEqual([person['id'] for person in response.json()['results']], ids)
+        self.assertLessEqual(len(context.captured_queries), 4)
+
+    def test_batch_invalid(self):
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.post(reverse('person-batch'), {'ids': [1], 'usernames': ['admin']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('person-batch'), {'ids': list(range(1, 5002))}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_skips_inactive(self):
+        self.guest_user.soft_delete()
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.post(reverse('person-batch'), {'ids': [self.guest_user.pk]}, format='json')
+        self.assertEqual(response.json()['missing'], [self.guest_user.pk])
+
+    def test_guest_batch(self):
+        self.client.force_authenticate(user=self.guest_user)
+        response = self.client.post(reverse('filter-person-batch'), {'ids': [self.admin_user.pk]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('username', response.json()['results'][0])
+        response = self.client.post(reverse('filter-person-batch'), {'usernames': ['admin']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('person-batch'), {'ids': [self.admin_user.pk]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class ConcurrentUpdateTestCase(TestCaseWithUsers):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(user=self.admin_user)
+        self.url = reverse('person-detail', args=[self.guest_user.pk])
+
+    def test_partial_update_writes_changed_fields(self):
+        password = self.guest_user.password
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(self.url, {'first_name': 'Jane', 'last_name': 'User'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        update = [query['sql'] for query in context.captured_queries
+                  if query['sql'].startswith('UPDATE') and 'first_name' in query['sql']]
+        self.assertEqual(len(update), 1)
+        self.assertNotIn('last_name', update[0])
+        self.assertNotIn('password', update[0])
+        self.guest_user.refresh_from_db()
+        self.assertEqual(self.guest_user.first_name, 'Jane')
+        self.assertEqual(self.guest_user.password, password)
+        self.assertEqual(self.guest_user.version, 2)
+
+    def test_etag_and_if_match(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['ETag'], '"1"')
+
+        response = self.client.patch(self.url, {'first_name': 'Jane'}, format='json', HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['ETag'], '"2"')
+
+        # A second editor still holding version 1 is rejected
+        response = self.client.patch(self.url, {'first_name': 'John'}, format='json', HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.guest_user.refresh_from_db()
+        self.assertEqual(self.guest_user.first_name, 'Jane')
+
+        response = self.client.patch(self.url, {'first_name': 'Jane'}, format='json', HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.patch(self.url, {'first_name': 'John'}, format='json', HTTP_IF_MATCH='bad')
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.patch(self.url, {'first_name': 'John'}, format='json', HTTP_IF_MATCH='*')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_weak_if_match_rejected(self):
+        response = self.client.patch(self.url, {'first_name': 'Jane'}, format='json', HTTP_IF_MATCH='W/"1"')
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_save_bumps_version(self):
+        # e.g. an edit through the admin site or changepassword
+        self.guest_user.set_password('newpassword')
+        self.guest_user.save()
+        self.assertEqual(self.guest_user.version, 2)
+        self.guest_user.first_name = 'Jane'
+        self.guest_user.save(update_fields=['first_name'])
+        self.assertEqual(self.guest_user.version, 3)
+        response = self.client.patch(self.url, {'first_name': 'John'}, format='json', HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_login_keeps_version(self):
+        self.assertTrue(self.client.login(username='guest', password='guest123'))
+        self.guest_user.refresh_from_db()
+        self.assertEqual(self.guest_user.version, 1)
+
+    def test_update_invalidates_stats(self):
+        generation = get_generation()
+        self.client.patch(self.url, {'first_name': 'Jane'}, format='json')
+        self.assertGreater(get_generation(), generation)
+
+    def test_stale_version_rejected_at_write(self):
+        # The row changes after the view loaded it but before the write
+        serializer = PersonSerializer(self.guest_user, data={'first_name': 'Jane'}, partial=True,
+                                      context={'expected_version': 1, 'request': None})
+        self.assertTrue(serializer.is_valid())
+        user_model.objects.filter(pk=self.guest_user.pk).update(version=2)
+        with self.assertRaises(PreconditionFailed):
+            serializer.save()
+
+    def test_unchanged_update_skips_write(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.patch(self.url, {'first_name': 'Guest'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(any(query['sql'].startswith('UPDATE') for query in context.captured_queries))
+        self.guest_user.refresh_from_db()
+        self.assertEqual(self.guest_user.version, 1)
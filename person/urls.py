@@ -6,6 +6,7 @@ from . import views
 router = routers.DefaultRouter()
 router.register(r'person', views.PersonViewSet, basename='person')
 router.register(r'filter-person', views.FilterPersonViewSet, basename='filter-person')
+router.register(r'person-job', views.PersonJobViewSet, basename='person-job')
 
 urlpatterns = [
     path('', include(router.urls))
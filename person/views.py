@@ -1,41 +1,141 @@
-from dateutil.relativedelta import relativedelta
-from django.utils.timezone import now
+import os
+import uuid
+from django.http import FileResponse
 from django.contrib.auth import get_user_model
 from django_filters import rest_framework as filters
-from rest_framework import mixins, viewsets, permissions, generics, exceptions
-from person.serializers import PersonSerializer, FilterPersonSerializer
+from rest_framework import mixins, viewsets, permissions, generics, exceptions, parsers, status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from person.serializers import (PersonSerializer, FilterPersonSerializer, PersonJobSerializer,
+                                BatchLookupSerializer, FilterBatchLookupSerializer,
+                                BatchLookupResultSerializer, FilterBatchLookupResultSerializer)
+from person.models import PersonJob
+from person.filters import PersonFilter
+from person.stats import get_stats
+from person.exceptions import PreconditionFailed
+from person import importer, jobs
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
 
-class PersonViewSet(viewsets.ModelViewSet):
+class BatchRetrieveMixin:
+    # Retrieve many persons with one IN query, in_bulk() splits it into
+    # chunks when the database limits query parameters
+    batch_lookup_serializer_class = BatchLookupSerializer
+    batch_lookup_fields = {'ids': 'id', 'usernames': 'username'}
+
+    @swagger_auto_schema(request_body=BatchLookupSerializer, responses={200: BatchLookupResultSerializer})
+    @action(detail=False, methods=['post'], pagination_class=None)
+    def batch(self, request):
+        lookup = self.batch_lookup_serializer_class(data=request.data)
+        lookup.is_valid(raise_exception=True)
+        (key, values), = lookup.validated_data.items()
+        values = list(dict.fromkeys(values))
+        found = self.get_queryset().in_bulk(values, field_name=self.batch_lookup_fields[key])
+        serializer = self.get_serializer([found[value] for value in values if value in found], many=True)
+        return Response({'results': serializer.data, 'missing': [value for value in values if value not in found]})
+
+
+class PersonViewSet(BatchRetrieveMixin, viewsets.ModelViewSet):
     serializer_class = PersonSerializer
     permission_classes = [permissions.IsAdminUser]
-    queryset = get_user_model().objects.all()
+    queryset = get_user_model().active.all()
 
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action in ('update', 'partial_update'):
+            context['expected_version'] = self.get_expected_version()
+        return context
 
-class PersonFilter(filters.FilterSet):
-    first_name = filters.CharFilter("first_name", "contains")
-    last_name  = filters.CharFilter("last_name",  "contains")
-    max_age    = filters.NumberFilter(method="filter_max_age")
-    min_age    = filters.NumberFilter(method="filter_min_age")
+    def get_expected_version(self):
+        # If-Match carries the ETag from a previous response, e.g. "3". It uses
+        # strong comparison (RFC 9110), so a weak W/"3" never matches.
+        if_match = self.request.headers.get('If-Match', '*').strip()
+        if if_match == '*':
+            return None
+        if not (len(if_match) > 2 and if_match[0] == if_match[-1] == '"' and if_match[1:-1].isdigit()):
+            raise PreconditionFailed()
+        return int(if_match[1:-1])
 
-    class Meta:
-        model = get_user_model()
-        fields = ["first_name", "last_name", "max_age", "min_age"]
+    def finalize_response(self, request, response, *args, **kwargs):
+        if self.detail and isinstance(response.data, dict) and 'version' in response.data:
+            response['ETag'] = f'"{response.data["version"]}"'
+        return super().finalize_response(request, response, *args, **kwargs)
 
-    def filter_max_age(self, query_set, name, value):
-        min_date_of_birth = now().date() - relativedelta(years=(value + 1))
-        return query_set.filter(date_of_birth__gt=min_date_of_birth)
-    
-    def filter_min_age(self, query_set, name, value):
-        max_date_of_birth = now().date() - relativedelta(years=value)
-        return query_set.filter(date_of_birth__lte=max_date_of_birth)
+    def perform_destroy(self, instance):
+        instance.soft_delete()
 
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('first_name', openapi.IN_QUERY, type=openapi.TYPE_STRING),
+        openapi.Parameter('last_name', openapi.IN_QUERY, type=openapi.TYPE_STRING),
+        openapi.Parameter('min_age', openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+        openapi.Parameter('max_age', openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+    ])
+    @action(detail=False, pagination_class=None)
+    def stats(self, request):
+        # Counts by age band, birth year and email domain, honoring PersonFilter params
+        filterset = PersonFilter(request.query_params, queryset=self.get_queryset(), request=request)
+        if not filterset.is_valid():
+            raise exceptions.ValidationError(filterset.errors)
+        return Response(get_stats(filterset.qs, filterset.form.cleaned_data))
 
-class FilterPersonViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
-    queryset = get_user_model().objects.all()
+    @swagger_auto_schema(manual_parameters=[
+        openapi.Parameter('file', openapi.IN_FORM, type=openapi.TYPE_FILE, required=True,
+                          description='.csv or .ndjson file, rows are upserted by username'),
+    ], responses={202: PersonJobSerializer})
+    @action(detail=False, methods=['post'], url_path='import', url_name='import', parser_classes=[parsers.MultiPartParser])
+    def import_persons(self, request):
+        # Large files are imported by a background job, see PersonJobViewSet
+        upload = request.data.get('file')
+        if upload is None:
+            raise exceptions.ValidationError({'file': 'No file was submitted.'})
+        file_format = importer.detect_format(upload.name)
+        if file_format is None:
+            raise exceptions.ValidationError({'file': 'Only .csv and .ndjson files are supported.'})
+        os.makedirs(jobs.JOB_DIR, exist_ok=True)
+        path = jobs.JOB_DIR / f'person-import-{uuid.uuid4().hex}.{file_format}'
+        with open(path, 'wb') as f:
+            for chunk in upload.chunks():
+                f.write(chunk)
+        job = PersonJob.objects.create(kind=PersonJob.IMPORT, created_by=request.user,
+                                       params={'path': str(path), 'format': file_format})
+        serializer = PersonJobSerializer(job, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+
+class FilterPersonViewSet(BatchRetrieveMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
+    queryset = get_user_model().active.all()
     serializer_class =  FilterPersonSerializer
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [filters.DjangoFilterBackend]
     filterset_class = PersonFilter
+    batch_lookup_serializer_class = FilterBatchLookupSerializer
+
+    @swagger_auto_schema(request_body=FilterBatchLookupSerializer, responses={200: FilterBatchLookupResultSerializer})
+    @action(detail=False, methods=['post'], pagination_class=None)
+    def batch(self, request):
+        return super().batch(request)
+
+
+class PersonJobViewSet(mixins.CreateModelMixin,
+                       mixins.RetrieveModelMixin,
+                       mixins.ListModelMixin,
+                       viewsets.GenericViewSet):
+    # Jobs are only queued here, `manage.py run_person_jobs` workers run them
+    serializer_class = PersonJobSerializer
+    permission_classes = [permissions.IsAdminUser]
+    queryset = PersonJob.objects.all()
+
+    def perform_create(self, serializer):
+        serializer.save(created_by=self.request.user)
+
+    @action(detail=True)
+    def download(self, request, pk=None):
+        job = self.get_object()
+        if job.kind != PersonJob.EXPORT or job.status != PersonJob.DONE:
+            raise exceptions.NotFound('Only finished export jobs can be downloaded.')
+        try:
+            export = open(jobs.export_path(job), 'rb')
+        except FileNotFoundError:
+            raise exceptions.NotFound('The export file no longer exists.')
+        return FileResponse(export, as_attachment=True, filename=f'person-export-{job.pk}.ndjson')